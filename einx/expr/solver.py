@@ -18,6 +18,8 @@ class Expression:
 
 class Variable(Expression):
     def __init__(self, id, name):
+        # id can be any hashable value (e.g. the raw id() of an expression node); name is only
+        # used in messages and may be any object that is stringified on demand
         Expression.__init__(self)
         self.id = id
         self.name = name
@@ -175,7 +177,7 @@ def solve(equations):
             # Use constant
             class_constants = set(constants[n] for n in eclass if n in constants)
             if len(class_constants) != 1:
-                names = set(variables[a].name for a in eclass)
+                names = set(str(variables[a].name) for a in eclass)
                 if len(names) == 1:
                     raise SolveException(f"Found contradictory values {class_constants} for expression '{next(iter(names))}'")
                 else:
@@ -183,7 +185,8 @@ def solve(equations):
             v = Constant(next(iter(class_constants)))
         else:
             # Create new variable for class
-            v = Variable(f"Class-{id(eclass)}", f"Equivalent expressions {set(variables[a].name for a in eclass)}")
+            class_id = f"Class-{id(eclass)}"
+            v = Variable(class_id, class_id)
         for n in eclass:
             assert not n in origvar_to_solvevar
             origvar_to_solvevar[n] = v
@@ -16,6 +16,17 @@ class Expression:
     def shape(self):
         return tuple(i[1] for i in self.ellipsis_indices) + (len(self),)
 
+    def all(self):
+        # Iterative preorder traversal: a recursive generator pays a frame per node, which
+        # dominates the cost of walking large trees
+        stack = [self]
+        while stack:
+            expr = stack.pop()
+            yield expr
+            children = expr.direct_children
+            if children:
+                stack.extend(reversed(children))
+
 class Composition(Expression):
     def __init__(self, inner, ellipsis_indices):
         Expression.__init__(self, ellipsis_indices)
@@ -34,9 +45,9 @@ class Composition(Expression):
     def __deepcopy__(self):
         return Composition(self.inner.__deepcopy__(), ellipsis_indices=self.ellipsis_indices)
 
-    def all(self):
-        yield self
-        yield from self.inner.all()
+    @property
+    def direct_children(self):
+        return (self.inner,)
 
 class List(Expression):
     @staticmethod
@@ -65,10 +76,9 @@ class List(Expression):
     def __deepcopy__(self):
         return List([c.__deepcopy__() for c in self.children], ellipsis_indices=self.ellipsis_indices)
 
-    def all(self):
-        yield self
-        for c in self.children:
-            yield from c.all()
+    @property
+    def direct_children(self):
+        return self.children
 
 class NamedAxis(Expression):
     def __init__(self, name, ellipsis_indices):
@@ -93,8 +103,9 @@ class NamedAxis(Expression):
     def __deepcopy__(self):
         return NamedAxis(self.name, ellipsis_indices=self.ellipsis_indices)
 
-    def all(self):
-        yield self
+    @property
+    def direct_children(self):
+        return ()
 
 class UnnamedAxis(Expression):
     def __init__(self, value, ellipsis_indices):
@@ -113,8 +124,9 @@ class UnnamedAxis(Expression):
     def __deepcopy__(self):
         return UnnamedAxis(self.value, ellipsis_indices=self.ellipsis_indices)
 
-    def all(self):
-        yield self
+    @property
+    def direct_children(self):
+        return ()
 
 class Concatenation(Expression):
     def __init__(self, children, ellipsis_indices):
@@ -138,10 +150,9 @@ class Concatenation(Expression):
     def __deepcopy__(self):
         return Concatenation([c.__deepcopy__() for c in self.children], ellipsis_indices=self.ellipsis_indices)
 
-    def all(self):
-        yield self
-        for c in self.children:
-            yield from c.all()
+    @property
+    def direct_children(self):
+        return self.children
 
 class Marker(Expression):
     def __init__(self, inner, ellipsis_indices):
@@ -161,9 +172,9 @@ class Marker(Expression):
     def __deepcopy__(self):
         return Marker(self.inner.__deepcopy__(), ellipsis_indices=self.ellipsis_indices)
 
-    def all(self):
-        yield self
-        yield from self.inner.all()
+    @property
+    def direct_children(self):
+        return (self.inner,)
 
 
 class SolveException(Exception):
@@ -725,32 +736,38 @@ expr_map.REPLACE_AND_STOP = 3
 expr_map.REPLACE_AND_CONTINUE = 4
 
 def _expr_map(expr, f):
+    out = []
+    _expr_map_into(expr, f, out)
+    return out
+
+def _expr_map_into(expr, f, out):
+    # Appends the mapped expressions into a caller-supplied accumulator instead of
+    # concatenating intermediate lists at every recursion level
     exprs, signal = f(expr)
     if signal == expr_map.REPLACE_AND_STOP:
         assert isinstance(exprs, list)
-        return exprs
+        out.extend(exprs)
     elif signal == expr_map.COPY_AND_STOP:
-        return [expr.__deepcopy__()]
+        out.append(expr.__deepcopy__())
     elif signal == expr_map.REPLACE_AND_CONTINUE:
-        return [c for expr in exprs for c in _expr_map(expr, f)]
-
-    if isinstance(expr, NamedAxis):
-        return [expr.__deepcopy__()]
+        for expr in exprs:
+            _expr_map_into(expr, f, out)
+    elif isinstance(expr, NamedAxis):
+        out.append(expr.__deepcopy__())
     elif isinstance(expr, UnnamedAxis):
-        return [expr.__deepcopy__()]
+        out.append(expr.__deepcopy__())
     elif isinstance(expr, Composition):
-        return [Composition(List.maybe(_expr_map(expr.inner, f)))]
+        out.append(Composition(List.maybe(_expr_map(expr.inner, f))))
     elif isinstance(expr, List):
-        return [c2 for c1 in expr.children for c2 in _expr_map(c1, f)]
+        for c in expr.children:
+            _expr_map_into(c, f, out)
     elif isinstance(expr, Concatenation):
-        return [Concatenation([List.maybe(_expr_map(c, f)) for c in expr.children])]
+        out.append(Concatenation([List.maybe(_expr_map(c, f)) for c in expr.children]))
     elif isinstance(expr, Marker):
         x = _expr_map(expr.inner, f)
-        if len(x) == 0:
-            # Drop empty marker
-            return []
-        else:
-            return [Marker(List.maybe(x))]
+        if len(x) > 0:
+            out.append(Marker(List.maybe(x)))
+        # else: Drop empty marker
     else:
         raise TypeError(f"Invalid expression type {type(expr)}")
 
@@ -1,20 +1,45 @@
 from . import stage2, solver
 import numpy as np
+import sys
 from functools import partial
+from math import prod
 import einx
 
 class Expression:
+    # Fixed attribute sets: solve() creates many hundreds of nodes per expression, and slots
+    # both shrink them and speed up the attribute accesses in the traversal utilities
+    __slots__ = ("value", "parent", "_hash", "_is_marked", "_is_at_root")
+
     def __init__(self, value):
-        if not isinstance(value, (int, np.int64, np.int32, np.int16, np.int8)):
+        if isinstance(value, int):
+            self.value = value
+        elif isinstance(value, np.integer):
+            self.value = int(value)
+        else:
             raise TypeError(f"Expected int, got {type(value)}")
-        self.value = int(value)
         self.parent = None
+        self._hash = None # Lazily computed and cached; expressions are immutable after construction (except for parent, which does not contribute to the hash)
+        self._is_marked = None # Lazily cached results of is_marked/is_at_root; reset by
+        self._is_at_root = None # _uncache_parent_predicates when the node is wired into a new parent
 
     @property
     def shape(self):
         return tuple(x.value for x in self)
 
+    def all(self):
+        # Iterative preorder traversal: a recursive generator pays a frame per node, which
+        # dominates the cost of walking large trees
+        stack = [self]
+        while stack:
+            expr = stack.pop()
+            yield expr
+            children = expr.direct_children
+            if children:
+                stack.extend(reversed(children))
+
 class Composition(Expression):
+    __slots__ = ("inner",)
+
     @staticmethod
     def maybe(inner):
         if len(inner) == 0:
@@ -27,6 +52,7 @@ class Composition(Expression):
     def __init__(self, inner):
         Expression.__init__(self, inner.value)
         self.inner = inner
+        _uncache_parent_predicates(inner)
         inner.parent = self
         assert len(inner) > 0
 
@@ -43,16 +69,26 @@ class Composition(Expression):
         return Composition(self.inner.__deepcopy__())
 
     def __eq__(self, other):
-        return isinstance(other, Composition) and self.inner == other.inner
+        if self is other:
+            return True
+        if not isinstance(other, Composition):
+            return False
+        if not self._hash is None and not other._hash is None and self._hash != other._hash:
+            return False
+        return self.inner == other.inner
 
     def __hash__(self):
-        return 8716123 + hash(self.inner)
+        if self._hash is None:
+            self._hash = 8716123 + hash(self.inner)
+        return self._hash
 
-    def all(self):
-        yield self
-        yield from self.inner.all()
+    @property
+    def direct_children(self):
+        return (self.inner,)
 
 class List(Expression):
+    __slots__ = ("children",)
+
     def maybe(l, *args, **kwargs):
         if not isinstance(l, list):
             raise TypeError(f"Expected list, got {type(l)}")
@@ -62,11 +98,12 @@ class List(Expression):
             return List(l, *args, **kwargs)
 
     def __init__(self, children):
-        Expression.__init__(self, np.prod([c.value for c in children]).astype(int))
+        Expression.__init__(self, prod(c.value for c in children))
         self.children = children
         for c in children:
             if isinstance(c, List):
                 raise ValueError("List cannot have another List as direct child")
+            _uncache_parent_predicates(c)
             c.parent = self
 
     def __str__(self):
@@ -83,20 +120,47 @@ class List(Expression):
         return List([c.__deepcopy__() for c in self.children])
 
     def __eq__(self, other):
-        return isinstance(other, List) and self.children == other.children
+        if self is other:
+            return True
+        if not isinstance(other, List) or len(self.children) != len(other.children):
+            return False
+        if not self._hash is None and not other._hash is None and self._hash != other._hash:
+            return False
+        return self.children == other.children
 
     def __hash__(self):
-        return 6563 + hash(tuple(self.children))
+        if self._hash is None:
+            h = 6563
+            for c in self.children:
+                h = h * 1000003 ^ hash(c)
+            self._hash = h
+        return self._hash
 
-    def all(self):
-        yield self
-        for c in self.children:
-            yield from c.all()
+    @property
+    def direct_children(self):
+        return self.children
 
 class Axis(Expression):
+    __slots__ = ("_name", "_is_unnamed")
+
     def __init__(self, name, value):
         Expression.__init__(self, value)
-        self.name = name if not name is None else f"unnamed.{id(self)}"
+        if name is None:
+            self._name = None
+            self._is_unnamed = True
+        else:
+            self._is_unnamed = name.startswith("unnamed.")
+            # Intern named axes: the same axis names are constructed over and over across trees,
+            # and interning makes the string comparisons in __eq__ pointer-fast. The id-based
+            # names of unnamed axes are unique and must not be pinned in the intern table.
+            self._name = name if self._is_unnamed else sys.intern(name)
+
+    @property
+    def name(self):
+        # The name of an unnamed axis is only materialized when it is actually requested
+        if self._name is None:
+            self._name = f"unnamed.{id(self)}"
+        return self._name
 
     def __repr__(self):
         return f"Axis({self.name}, {self.value})"
@@ -114,6 +178,8 @@ class Axis(Expression):
         return Axis(self.name, self.value)
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if not isinstance(other, Axis):
             return False
         if self.is_unnamed != other.is_unnamed:
@@ -126,16 +192,21 @@ class Axis(Expression):
             return self.name == other.name
 
     def __hash__(self):
-        return 9817234 + (hash(self.name) if not self.is_unnamed else 0) + hash(self.value)
+        if self._hash is None:
+            self._hash = 9817234 + (hash(self.name) if not self.is_unnamed else 0) + hash(self.value)
+        return self._hash
 
-    def all(self):
-        yield self
+    @property
+    def direct_children(self):
+        return ()
 
     @property
     def is_unnamed(self):
-        return self.name.startswith("unnamed.")
+        return self._is_unnamed
 
 class Concatenation(Expression):
+    __slots__ = ("children",)
+
     @staticmethod
     def maybe(l, *args, **kwargs):
         if not isinstance(l, list):
@@ -148,11 +219,12 @@ class Concatenation(Expression):
     def __init__(self, children):
         if len(children) == 0:
             raise ValueError("Concatenation must have at least one child")
-        Expression.__init__(self, np.sum([c.value for c in children]).astype("int32"))
+        Expression.__init__(self, sum(c.value for c in children))
         self.children = children
         for c in children:
             if len(c) != 1:
                 raise ValueError(f"Concatenation can only be used on expressions of length 1, but got expression '{c}'")
+            _uncache_parent_predicates(c)
             c.parent = self
 
     def __str__(self):
@@ -168,22 +240,35 @@ class Concatenation(Expression):
         return Concatenation([c.__deepcopy__() for c in self.children])
 
     def __eq__(self, other):
-        return isinstance(other, Concatenation) and self.children == other.children
+        if self is other:
+            return True
+        if not isinstance(other, Concatenation) or len(self.children) != len(other.children):
+            return False
+        if not self._hash is None and not other._hash is None and self._hash != other._hash:
+            return False
+        return self.children == other.children
 
     def __hash__(self):
-        return 123 + hash(tuple(self.children))
+        if self._hash is None:
+            h = 123
+            for c in self.children:
+                h = h * 1000003 ^ hash(c)
+            self._hash = h
+        return self._hash
 
-    def all(self):
-        yield self
-        for c in self.children:
-            yield from c.all()
+    @property
+    def direct_children(self):
+        return self.children
 
 class Marker(Expression):
+    __slots__ = ("inner",)
+
     def __init__(self, inner):
         if len(inner) == 0:
             raise ValueError("Marker cannot have empty list as child")
         Expression.__init__(self, inner.value)
         self.inner = inner
+        _uncache_parent_predicates(inner)
         inner.parent = self
 
     def __str__(self):
@@ -199,14 +284,22 @@ class Marker(Expression):
         return Marker(self.inner.__deepcopy__())
 
     def __eq__(self, other):
-        return isinstance(other, Marker) and self.inner == other.inner
+        if self is other:
+            return True
+        if not isinstance(other, Marker):
+            return False
+        if not self._hash is None and not other._hash is None and self._hash != other._hash:
+            return False
+        return self.inner == other.inner
 
     def __hash__(self):
-        return 6433236 + hash(self.inner)
+        if self._hash is None:
+            self._hash = 6433236 + hash(self.inner)
+        return self._hash
 
-    def all(self):
-        yield self
-        yield from self.inner.all()
+    @property
+    def direct_children(self):
+        return (self.inner,)
 
 
 
@@ -219,6 +312,9 @@ class SolveValueException(Exception):
             self.message += f"    '{einx.expr.util._to_str(expr1)} = {einx.expr.util._to_str(expr2)}'\n"
         super().__init__(self.message)
 
+_solve_cache = {}
+_solve_cache_max_size = 4096
+
 def solve(exprs1, exprs2):
     exprs1 = list(exprs1)
     exprs2 = list(exprs2)
@@ -227,33 +323,72 @@ def solve(exprs1, exprs2):
     if len(exprs1) != len(exprs2):
         raise ValueError("Number of expressions must be equal")
 
+    # The result depends only on the structure of the input expressions, which is fully captured
+    # by their string representations. Cached results are deep-copied on every return, since
+    # callers are allowed to rewire the returned trees into new parents.
+    cache_key = tuple(str(expr) if not expr is None else None for expr in exprs1 + exprs2)
+    cached = _solve_cache.get(cache_key, None)
+    if not cached is None:
+        cached_exprs1, cached_exprs2 = cached
+        return [expr.__deepcopy__() if not expr is None else None for expr in cached_exprs1], \
+               [expr.__deepcopy__() if not expr is None else None for expr in cached_exprs2]
+
     equations = []
 
+    # Materialize the traversal of each root once; the node lists are iterated several times below
+    all_nodes = [list(root.all()) for root in exprs1 + exprs2 if not root is None]
+
+    # Variables are tagged with the raw integer id of their node; the expression itself serves
+    # as the variable name and is only stringified if it ends up in an error message
     symbolic_expr_values = {}
-    for root in exprs1 + exprs2:
-        if not root is None:
-            for expr in root.all():
-                symbolic_expr_values[id(expr)] = solver.Variable(f"symbolic_expr_values[{id(expr)}]", str(expr))
-
-    # Add equations: Relations between expressions and their children
-    for root in exprs1 + exprs2:
-        if not root is None:
-            for expr in root.all():
-                if isinstance(expr, stage2.List):
-                    equations.append((
-                        solver.Product([symbolic_expr_values[id(c)] for c in expr.children]),
-                        symbolic_expr_values[id(expr)],
-                    ))
-                elif isinstance(expr, stage2.Concatenation):
-                    equations.append((
-                        solver.Sum([symbolic_expr_values[id(c)] for c in expr.children]),
-                        symbolic_expr_values[id(expr)],
-                    ))
-                elif isinstance(expr, stage2.Marker) or isinstance(expr, stage2.Composition):
-                    equations.append((
-                        symbolic_expr_values[id(expr)],
-                        symbolic_expr_values[id(expr.inner)],
-                    ))
+    for root_nodes in all_nodes:
+        for expr in root_nodes:
+            symbolic_expr_values[id(expr)] = solver.Variable(id(expr), expr)
+
+    # Add equations in a single fused pass over the nodes:
+    # - Relations between expressions and their children. Product.maybe/Sum.maybe turn
+    #   single-child relations into direct variable equalities, which the solver resolves
+    #   through its equivalence classes without involving sympy.
+    # - Values of unnamed axes
+    # - Multiple occurrences of the same named axis must have the same value
+    sev = symbolic_expr_values
+    append_equation = equations.append
+    sympy_axis_values = {}
+    for root_nodes in all_nodes:
+        for expr in root_nodes:
+            # Exact type checks: the stage2 node classes are never subclassed, and this skips
+            # the MRO walk of isinstance in the hottest dispatch loop
+            t = type(expr)
+            if t is stage2.List:
+                append_equation((
+                    solver.Product.maybe([sev[id(c)] for c in expr.children]),
+                    sev[id(expr)],
+                ))
+            elif t is stage2.Concatenation:
+                append_equation((
+                    solver.Sum.maybe([sev[id(c)] for c in expr.children]),
+                    sev[id(expr)],
+                ))
+            elif t is stage2.Marker or t is stage2.Composition:
+                append_equation((
+                    sev[id(expr)],
+                    sev[id(expr.inner)],
+                ))
+            elif t is stage2.UnnamedAxis:
+                append_equation((
+                    sev[id(expr)],
+                    int(expr.value),
+                ))
+            elif t is stage2.NamedAxis:
+                axis_value = sympy_axis_values.get(expr.name)
+                if axis_value is None:
+                    # The axis name doubles as the variable id; its string type keeps it
+                    # distinct from the integer ids of the per-node variables above
+                    axis_value = sympy_axis_values[expr.name] = solver.Variable(expr.name, expr.name)
+                append_equation((
+                    sev[id(expr)],
+                    axis_value,
+                ))
 
     # Add equations: Same root values
     for root1, root2 in zip(exprs1, exprs2):
@@ -265,74 +400,56 @@ def solve(exprs1, exprs2):
                     symbolic_expr_values[id(expr2)],
                 ))
 
-    # Add equations: Unnamed axes
-    for root in exprs1 + exprs2:
-        if not root is None:
-            for expr in root.all():
-                if isinstance(expr, stage2.UnnamedAxis):
-                    equations.append((
-                        symbolic_expr_values[id(expr)],
-                        int(expr.value),
-                    ))
-
-    # Add equations: Multiple occurrences of the same named axis must have the same value
-    sympy_axis_values = {}
-    for root in exprs1 + exprs2:
-        if not root is None:
-            for axis in root.all():
-                if isinstance(axis, stage2.NamedAxis):
-                    if not axis.name in sympy_axis_values:
-                        sympy_axis_values[axis.name] = solver.Variable(f"sympy_axis_values[{axis.name}]", axis.name)
-                    equations.append((
-                        symbolic_expr_values[id(axis)],
-                        sympy_axis_values[axis.name],
-                    ))
-
     # Solve
     try:
         solutions = solver.solve(equations)
     except solver.SolveException as e:
         raise SolveValueException(exprs1, exprs2, str(e))
-    axis_values = {}
-    for k, v in solutions.items():
-        if k.startswith("symbolic_expr_values["):
-            axis_values[int(k[len("symbolic_expr_values["):-1])] = int(v)
+    # Expression variables carry integer ids, the named-axis variables below carry string ids
+    axis_values = {k: int(v) for k, v in solutions.items() if isinstance(k, int)}
 
     failed_axes = set()
-    for root in exprs1 + exprs2:
-        if not root is None:
-            for expr in root.all():
-                if isinstance(expr, stage2.NamedAxis):
-                    if not id(expr) in axis_values:
-                        failed_axes.add(str(expr))
+    for root_nodes in all_nodes:
+        for expr in root_nodes:
+            if type(expr) is stage2.NamedAxis:
+                if not id(expr) in axis_values:
+                    failed_axes.add(str(expr))
     if len(failed_axes) > 0:
         raise SolveValueException(exprs1, exprs2, f"Found no unique solutions for {failed_axes}")
 
     # Map stage2 expressions to stage3 expressions
     def map(expr):
-        if isinstance(expr, stage2.NamedAxis):
+        t = type(expr)
+        if t is stage2.NamedAxis:
             assert id(expr) in axis_values
             if axis_values[id(expr)] <= 0:
                 raise SolveValueException(exprs1, exprs2, f"Axis '{expr}' has value {axis_values[id(expr)]} <= 0")
             return Axis(expr.name, axis_values[id(expr)])
-        elif isinstance(expr, stage2.UnnamedAxis):
+        elif t is stage2.UnnamedAxis:
             assert id(expr) in axis_values
             if axis_values[id(expr)] <= 0:
                 raise SolveValueException(exprs1, exprs2, f"Axis '{expr}' has value {axis_values[id(expr)]} <= 0")
             return Axis(None, axis_values[id(expr)])
-        elif isinstance(expr, stage2.List):
+        elif t is stage2.List:
             return List([map(child) for child in expr.children])
-        elif isinstance(expr, stage2.Concatenation):
+        elif t is stage2.Concatenation:
             return Concatenation([map(child) for child in expr.children])
-        elif isinstance(expr, stage2.Marker):
+        elif t is stage2.Marker:
             return Marker(map(expr.inner))
-        elif isinstance(expr, stage2.Composition):
+        elif t is stage2.Composition:
             return Composition.maybe(map(expr.inner))
         else:
             assert False, type(expr)
     exprs1 = [map(root) if not root is None else None for root in exprs1]
     exprs2 = [map(root) if not root is None else None for root in exprs2]
 
+    if len(_solve_cache) >= _solve_cache_max_size:
+        _solve_cache.clear()
+    _solve_cache[cache_key] = (
+        [expr.__deepcopy__() if not expr is None else None for expr in exprs1],
+        [expr.__deepcopy__() if not expr is None else None for expr in exprs2],
+    )
+
     return exprs1, exprs2
 
 
@@ -365,37 +482,72 @@ expr_map.REPLACE_AND_STOP = 3
 expr_map.REPLACE_AND_CONTINUE = 4
 
 def _expr_map(expr, f):
+    out = []
+    _expr_map_into(expr, f, out)
+    return out
+
+def _expr_map_into(expr, f, out):
+    # Appends the mapped expressions into a caller-supplied accumulator instead of
+    # concatenating intermediate lists at every recursion level
     exprs, signal = f(expr)
     if signal == expr_map.REPLACE_AND_STOP:
         assert isinstance(exprs, list)
-        return exprs
+        out.extend(exprs)
+        return
     elif signal == expr_map.COPY_AND_STOP:
-        return [expr.__deepcopy__()]
+        out.append(expr.__deepcopy__())
+        return
     elif signal == expr_map.REPLACE_AND_CONTINUE:
-        return [c for expr in exprs for c in _expr_map(expr, f)]
-
-    if isinstance(expr, Axis):
-        return [expr.__deepcopy__()]
-    elif isinstance(expr, Composition):
-        return [Composition.maybe(List.maybe(_expr_map(expr.inner, f)))]
-    elif isinstance(expr, List):
-        return [c2 for c1 in expr.children for c2 in _expr_map(c1, f)]
-    elif isinstance(expr, Concatenation):
-        children = [List.maybe(_expr_map(c, f)) for c in expr.children]
-        children = [c if len(c) > 0 else Axis(None, 1) for c in children]
-        return [Concatenation(children)]
-    elif isinstance(expr, Marker):
+        for expr in exprs:
+            _expr_map_into(expr, f, out)
+        return
+
+    t = type(expr)
+    if t is Axis:
+        out.append(expr.__deepcopy__())
+    elif t is Composition:
+        out.append(Composition.maybe(List.maybe(_expr_map(expr.inner, f))))
+    elif t is List:
+        for c in expr.children:
+            _expr_map_into(c, f, out)
+    elif t is Concatenation:
+        children = []
+        for c in expr.children:
+            c = List.maybe(_expr_map(c, f))
+            if len(c) == 0:
+                # The trivial axis cannot be a shared singleton: it is wired into the
+                # concatenation and needs its own parent pointer and unnamed name
+                c = Axis(None, 1)
+            children.append(c)
+        out.append(Concatenation(children))
+    elif t is Marker:
         x = _expr_map(expr.inner, f)
-        if len(x) == 0:
-            # Drop empty marker
-            return []
-        else:
-            return [Marker(List.maybe(x))]
+        if len(x) > 0:
+            out.append(Marker(List.maybe(x)))
+        # else: Drop empty marker
     else:
         raise TypeError(f"Invalid expression type {type(expr)}")
 
 
 
+def _memoize_transform(f):
+    # Caches pure expression-to-expression transforms. Structural equality ignores the names
+    # of unnamed axes while callers correlate axes across trees by name, so the key includes
+    # the unnamed names of the input in traversal order. Results are deep-copied on every
+    # return since callers may rewire them into new parents.
+    cache = {}
+    max_cache_size = 2048
+    def inner(expr):
+        key = (expr, tuple(a.name for a in expr.all() if type(a) is Axis and a.is_unnamed))
+        out = cache.get(key)
+        if out is None:
+            if len(cache) >= max_cache_size:
+                cache.clear()
+            out = cache[key] = f(expr)
+        return out.__deepcopy__()
+    return inner
+
+@_memoize_transform
 @expr_map
 def decompose(expr):
     if isinstance(expr, Composition):
@@ -403,6 +555,7 @@ def decompose(expr):
     elif isinstance(expr, Concatenation):
         return None, expr_map.COPY_AND_STOP
 
+@_memoize_transform
 @expr_map
 def demark(expr):
     if isinstance(expr, Marker):
@@ -419,6 +572,7 @@ def remove(expr, pred):
     if pred(expr):
         return [], expr_map.REPLACE_AND_STOP
 
+@_memoize_transform
 def remove_unnamed_trivial_axes(expr):
     def is_concat_child(expr): # Do not remove direct children of concatenations
         return not expr.parent is None and (isinstance(expr.parent, Concatenation) or (isinstance(expr.parent, Marker) and is_concat_child(expr.parent)))
@@ -426,8 +580,15 @@ def remove_unnamed_trivial_axes(expr):
 
 @expr_map
 def mark(expr, pred):
+    # The marked subtree must be deep-copied: wrapping the original in a Marker would rewire
+    # its parent pointer and corrupt the input tree for later predicate queries
     if not isinstance(expr, Marker) and (expr.parent is None or not isinstance(expr.parent, Marker)) and pred(expr):
-        return Marker(expr.__deepcopy__()), expr_map.REPLACE_AND_CONTINUE
+        marked = Marker(expr.__deepcopy__())
+        if type(expr) is Axis:
+            # An axis has no descendants that could be marked further, so the copy does not
+            # need to be walked (and copied) again
+            return marked, expr_map.REPLACE_AND_STOP
+        return marked, expr_map.REPLACE_AND_CONTINUE
 
 def any_parent_is(expr, pred, include_self=True):
     if not include_self:
@@ -440,11 +601,38 @@ def any_parent_is(expr, pred, include_self=True):
         expr = expr.parent
     return False
 
+def _uncache_parent_predicates(expr):
+    # A cached predicate result implies that all ancestors at query time were also cached (the
+    # lazy lookups below fill the entire parent chain), so descendants only need to be reset
+    # when the node itself holds a cached value
+    if not expr._is_marked is None or not expr._is_at_root is None:
+        for e in expr.all():
+            e._is_marked = None
+            e._is_at_root = None
+
 def is_marked(expr):
-    return any_parent_is(expr, lambda expr: isinstance(expr, Marker))
+    result = expr._is_marked
+    if result is None:
+        if isinstance(expr, Marker):
+            result = True
+        elif expr.parent is None:
+            result = False
+        else:
+            result = is_marked(expr.parent)
+        expr._is_marked = result
+    return result
 
 def is_at_root(expr):
-    return not any_parent_is(expr, lambda expr: isinstance(expr, Composition))
+    result = expr._is_at_root
+    if result is None:
+        if isinstance(expr, Composition):
+            result = False
+        elif expr.parent is None:
+            result = True
+        else:
+            result = is_at_root(expr.parent)
+        expr._is_at_root = result
+    return result
 
 def is_flat(expr):
     return all(not isinstance(expr, Composition) and not isinstance(expr, Concatenation) for expr in expr.all())
@@ -456,15 +644,16 @@ def get_named_axes(expr):
     return [expr for expr in expr.all() if isinstance(expr, Axis) and not expr.is_unnamed]
 
 def _get_marked(expr):
-    if isinstance(expr, Axis):
+    t = type(expr)
+    if t is Axis:
         return []
-    elif isinstance(expr, Marker):
+    elif t is Marker:
         return [expr.inner.__deepcopy__()]
-    elif isinstance(expr, Concatenation):
+    elif t is Concatenation:
         return [Concatenation.maybe([x for c in expr.children for x in _get_marked(c)])]
-    elif isinstance(expr, Composition):
+    elif t is Composition:
         return [Composition.maybe(List.maybe(_get_marked(expr.inner)))]
-    elif isinstance(expr, List):
+    elif t is List:
         return [List.maybe([x for c in expr.children for x in _get_marked(c)])]
     else:
         raise TypeError(f"Invalid expression type {type(expr)}")
@@ -4,6 +4,16 @@ from functools import partial
 import jax.numpy as jnp
 from typing import Optional, Callable
 
+# Maps the name of the calling operation to a function that builds the default initializer,
+# resolved once at import time instead of chained string comparisons on every factory call
+_init_factories = {
+    "get_at": lambda dtype, kwargs: jax.nn.initializers.normal(stddev=0.02),
+    "rearrange": lambda dtype, kwargs: jax.nn.initializers.normal(stddev=0.02),
+    "add": lambda dtype, kwargs: jax.nn.initializers.constant(0.0, dtype=dtype),
+    "multiply": lambda dtype, kwargs: jax.nn.initializers.constant(1.0, dtype=dtype),
+    "dot": lambda dtype, kwargs: jax.nn.initializers.lecun_normal(kwargs["in_axis"], kwargs["out_axis"], kwargs["batch_axis"]),
+}
+
 def param(module, name=None, init=None, dtype=None, rng=None):
     """Create a tensor factory for Equinox parameters.
 
@@ -17,36 +27,31 @@ def param(module, name=None, init=None, dtype=None, rng=None):
         A tensor factory with the given default parameters.
     """
 
-    def equinox_param_factory(shape, name=name, dtype=dtype, init=init, **kwargs):
+    if dtype is None and hasattr(module, "dtype"):
+        dtype = module.dtype
+
+    def equinox_param_factory(shape, name=name, dtype=dtype, init=init, rng=rng, **kwargs):
         if name is None:
             raise ValueError("Must specify name for tensor factory eqx.Module")
 
         if dtype is None:
-            if hasattr(module, "dtype"):
-                dtype = module.dtype
-            else:
-                dtype = "float32"
+            dtype = "float32"
 
         if init is None:
             raise ValueError("Must specify init for tensor factory eqx.Module")
         elif isinstance(init, str):
-            if init == "get_at" or init == "rearrange":
-                init = jax.nn.initializers.normal(stddev=0.02)
-            elif init == "add":
-                init = jax.nn.initializers.constant(0.0, dtype=dtype)
-            elif init == "multiply":
-                init = jax.nn.initializers.constant(1.0, dtype=dtype)
-            elif init == "dot":
-                init = jax.nn.initializers.lecun_normal(kwargs["in_axis"], kwargs["out_axis"], kwargs["batch_axis"])
-            else:
+            init_factory = _init_factories.get(init)
+            if init_factory is None:
                 raise ValueError(f"Don't know which initializer to use for operation '{init}'")
+            init = init_factory(dtype, kwargs)
         elif isinstance(init, (int, float)):
             init = jax.nn.initializers.constant(init, dtype=dtype)
 
-        if not vars(module)[name] is None:
-            tensor = vars(module)[name]
-        else:
-            tensor = vars(module)[name] = init(rng, shape, dtype)
+        tensor = getattr(module, name)
+        if tensor is None:
+            tensor = init(rng, shape, dtype)
+            # eqx.Module is a frozen dataclass, so bypass its __setattr__
+            object.__setattr__(module, name, tensor)
         return tensor
     return equinox_param_factory
 
@@ -91,6 +96,10 @@ class Norm(eqx.Module):
         self.kwargs = kwargs
 
     def __call__(self, x, rng=None):
+        # The factories must be rebuilt from the current self on every call: equinox tree
+        # transformations (filter_jit, apply_updates, inference_mode, ...) reconstruct the
+        # module, and a factory stored at __init__ time would keep reading the parameters of
+        # the original instance
         x, mean, var = einx.nn.norm(
             x,
             self.stats,
@@ -120,6 +129,8 @@ class Linear(eqx.Module):
         self.kwargs = kwargs
 
     def __call__(self, x, rng=None):
+        # See Norm.__call__: the factories must capture the current self, not the instance
+        # that was alive at __init__ time
         return einx.nn.linear(
             x,
             self.expr,